@@ -14,33 +14,39 @@ from astroid.builder import AstroidBuilder
 from pylint.lint import PyLinter
 from pylint.checkers.variables import VariablesChecker
 from pylint.interfaces import UNDEFINED
-from pylint.utils import PyLintASTWalker
+from pylint.utils import FileState, PyLintASTWalker
 from os.path import join, splitext
 import os
+import pickle
 import re
 import sys
-import ipdb
+import tempfile
+import time
 
-if os.sep == '\\':
+#Matches both Windows and POSIX separators, compiled once at import time since it is matched against every module
+_WEB2PY_RE = re.compile(r'(.+?)[\\/]applications[\\/](.+?)[\\/](.+?)[\\/]')
 
-    web2py_pattern = r'(.+?)\\applications\\(.+?)\\(.+?)\\'
-else:
-    web2py_pattern = r'(.+?)/applications/(.+?)/(.+?)/' 
+#Model names listed by previous runs, keyed by models path, stored with models path mtime. Set PYLINT_WEB2PY2_CACHE=0 to disable
+_MODELS_CACHE_PATH = join(os.path.expanduser('~'), '.cache', 'pylint_web2py2', 'models.pkl')
+#Listings done sooner than this after models path mtime are not cached, coarse mtime may miss later changes
+_MODELS_CACHE_RACY_SECONDS = 2
+
+#Parsed fake modules with frozensets of their global names, keyed by their source.
+#Every model/controller of an app shares a few of them
+_fake_modules = {}
+
+def _build_fake(fake_code):
+    'Build astroid module and its global names from fake code, parsing each distinct code only once'
+    fake_entry = _fake_modules.get(fake_code)
+    if fake_entry is None:
+        fake = AstroidBuilder(MANAGER).string_build(fake_code)
+        fake_entry = _fake_modules[fake_code] = (fake, frozenset(fake.globals))
+    return fake_entry
 
 def register(_):
     'Register web2py transformer, called by pylint'
     MANAGER.register_transform(scoped_nodes.Module, web2py_transform)
 
-def web2py_transform(module):
-    'Add imports and some default objects, add custom module paths to pythonpath'
-
-    if module.file:
-        #Check if this file belongs to web2py
-        web2py_match = re.match(web2py_pattern, module.file)
-        if web2py_match:
-            web2py_path, app_name, subfolder = web2py_match.group(1), web2py_match.group(2), web2py_match.group(3)
-            return transformer.transform_module(module, web2py_path, app_name, subfolder)
-
 class Web2PyTransformer(object):
     'Transforms web2py modules code'
     # This dummy code is copied from gluon/__init__.py
@@ -64,6 +70,8 @@ session = Session()
 cache = Cache(request)
 T = translator(request)
 '''
+    #Transform method names for app subfolders
+    subfolder_transforms = {'models': '_trasform_model', 'controllers': '_transform_controller'}
 
     def __init__(self):
         '''
@@ -72,6 +80,10 @@ T = translator(request)
         '''
         self.is_pythonpath_modified = False
         self.app_model_names = []
+        self.model_fake_codes = {}
+        self.controller_fake_code = self.fake_code
+        self.sniffer = None
+        self.walker = None
         self.top_level = True
 
     def transform_module(self, module_node, web2py_path, app_name, subfolder):
@@ -82,16 +94,16 @@ T = translator(request)
         #Add web2py modules paths to sys.path
         self._add_paths(web2py_path, app_name)
 
-        if subfolder == 'models':
-            self.top_level = False
-            transformed_module = self._trasform_model(module_node)
-            self.top_level = True
-        elif subfolder == 'controllers':
-            self.top_level = False
-            transformed_module = self._transform_controller(module_node)
+        transform_name = self.subfolder_transforms.get(subfolder)
+        if transform_name is None: #Modules are left as is
+            return module_node
+
+        self.top_level = False
+        try:
+            transformed_module = getattr(self, transform_name)(module_node)
+        finally:
+            #Don't leave following files untransformed if this one failed
             self.top_level = True
-        else:
-            transformed_module = module_node
 
         return transformed_module
 
@@ -106,8 +118,10 @@ Add models path too to be able to import it from the fake code
             app_modules_path = join(web2py_path, 'applications', app_name, 'modules')
             app_models_path = join(web2py_path, 'applications', app_name, 'models') #Add models to import them them in controllers
 
-            for module_path in [gluon_path, site_packages_path, app_modules_path, app_models_path, web2py_path]:
-                sys.path.append(module_path)
+            #Skip paths already there, every extra entry slows down module lookups
+            existing_paths = set(sys.path)
+            sys.path.extend(module_path for module_path in [gluon_path, site_packages_path, app_modules_path, app_models_path, web2py_path]
+                            if module_path not in existing_paths)
 
             self._fill_app_model_names(app_models_path)
 
@@ -116,78 +130,149 @@ Add models path too to be able to import it from the fake code
 
     def _trasform_model(self, module_node):
         'Add globals from fake code + import code from previous (in alphabetical order) models'
-        fake_code = self.fake_code + self._gen_models_import_code(module_node.name)
-        fake = AstroidBuilder(MANAGER).string_build(fake_code)
-        module_node.locals.update(fake.globals)
-
-        module_node = self._remove_unused_imports(module_node, fake)
-        return module_node
+        #Models not found in the listing import all top-level models
+        fake_code = self.model_fake_codes.get(module_node.name, self.controller_fake_code)
+        return self._apply_fake(module_node, fake_code)
 
     def _transform_controller(self, module_node):
         'Add globals from fake code + import models'
-        fake_code = self.fake_code + self._gen_models_import_code()
-
-        fake = AstroidBuilder(MANAGER).string_build(fake_code)
-        module_node.locals.update(fake.globals)
-
-        module_node = self._remove_unused_imports(module_node, fake)
-
+        return self._apply_fake(module_node, self.controller_fake_code)
+
+    def _apply_fake(self, module_node, fake_code):
+        'Add globals defined by fake code to module, except ones reported as unused'
+        fake, fake_globals = _build_fake(fake_code)
+        #Names defined in module itself shadow fake ones
+        module_locals = module_node.locals
+        for name, nodes in fake.globals.items():
+            if name not in module_locals:
+                module_locals[name] = nodes
+
+        module_node = self._remove_unused_imports(module_node, fake, fake_globals)
         return module_node
 
-    def _gen_models_import_code(self, current_model=None):
-        'Generate import code for models (only previous in alphabetical order if called by model)'
-        code = ''
-        for model_name in self.app_model_names:
-            if current_model and model_name == current_model:
-                break
-            code += 'from %s import *\n' % model_name
-
-        return code
-
     def _fill_app_model_names(self, app_models_path):
         'Save model names for later use'
-        model_files = os.listdir(app_models_path)
-        model_files = [model_file for model_file in model_files if re.match(r'.+?\.py$', model_file)] #Only top-level models
-        model_files = sorted(model_files) #Models are executed in alphabetical order
-        self.app_model_names = [re.match(r'^(.+?)\.py$', model_file).group(1) for model_file in model_files]
+        use_cache = os.environ.get('PYLINT_WEB2PY2_CACHE', '1') != '0'
+        if use_cache:
+            #Adding or removing a model changes the directory mtime
+            mtime = os.stat(app_models_path).st_mtime
+            cache = self._load_models_cache()
+            cached_mtime, model_names = cache.get(app_models_path, (None, None))
+            if cached_mtime != mtime:
+                model_names = None
+        else:
+            model_names = None
+
+        if model_names is None:
+            model_files = os.listdir(app_models_path)
+            #Only top-level models, executed in alphabetical order
+            model_names = sorted(model_file[:-3] for model_file in model_files if model_file.endswith('.py'))
+            #With coarse mtime resolution a model added right after listing may keep the same mtime,
+            #so listing is saved only if done well after the last change (like git's racy timestamp check)
+            if use_cache and time.time() - mtime >= _MODELS_CACHE_RACY_SECONDS:
+                #Replaces outdated entry for this path, so cache doesn't grow with every models change
+                cache[app_models_path] = (mtime, model_names)
+                self._save_models_cache(cache)
+
+        self.app_model_names = model_names
+        self._fill_fake_codes()
+
+    @staticmethod
+    def _load_models_cache():
+        'Load model names cache from disk, missing or broken cache is treated as empty'
+        try:
+            with open(_MODELS_CACHE_PATH, 'rb') as cache_file:
+                cache = pickle.load(cache_file)
+        except Exception: #pylint: disable=broad-except
+            return {}
+        if not isinstance(cache, dict):
+            return {}
+        #Drop entries in unexpected format, e.g. written by older versions
+        return dict((path, entry) for path, entry in cache.items() if isinstance(entry, tuple) and len(entry) == 2)
+
+    @staticmethod
+    def _save_models_cache(cache):
+        'Write model names cache to disk, failure only costs a listing on the next run'
+        tmp_path = None
+        try:
+            cache_dir = os.path.dirname(_MODELS_CACHE_PATH)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            #Write to temp file and rename it, so concurrent pylint runs never see a half-written cache
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(tmp_fd, 'wb') as cache_file:
+                pickle.dump(cache, cache_file, pickle.HIGHEST_PROTOCOL)
+            getattr(os, 'replace', os.rename)(tmp_path, _MODELS_CACHE_PATH) #No os.replace in Python 2
+            tmp_path = None
+        except (IOError, OSError):
+            pass
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    def _fill_fake_codes(self):
+        'Precompute fake code for every model (imports only previous models) and for controllers (imports all models)'
+        import_code = ''
+        self.model_fake_codes = {}
+        for model_name in self.app_model_names:
+            self.model_fake_codes[model_name] = self.fake_code + import_code
+            import_code += 'from %s import *\n' % model_name
+
+        self.controller_fake_code = self.fake_code + import_code
 
-    def _remove_unused_imports(self, module_node, fake_node):
+    def _remove_unused_imports(self, module_node, fake_node, fake_globals):
         '''
 We import objects from fake code and from models, so pylint doesn't complain about undefined objects.
 But now it complains a lot about unused imports.
 We cannot suppress it, so we call VariableChecker with fake linter to intercept and collect all such error messages,
 and then use them to remove unused imports.
         '''
-        #Needed for removal of unused import messages
-        sniffer = MessageSniffer() #Our linter substitution
-        walker = PyLintASTWalker(sniffer)
-        var_checker = VariablesChecker(sniffer)
-        walker.add_checker(var_checker)
+        sniffer, walker = self._get_sniffer()
 
         #Collect unused import messages
-        sniffer.set_fake_node(fake_node)
+        sniffer.set_fake_globals(fake_globals)
         sniffer.check_astroid_module(module_node, walker, [], [])
 
         #Remove unneeded globals imported from fake code
-        for name in sniffer.unused:
-            if name in fake_node.globals and \
-              name in module_node.locals: #Maybe it's already deleted
+        for name in sniffer.unused & fake_globals:
+            #Maybe it's already deleted or defined by module itself
+            if module_node.locals.get(name) is fake_node.globals[name]:
                 del module_node.locals[name]
 
         return module_node
 
+    def _get_sniffer(self):
+        'Create linter substitution and its walker on first use, PyLinter is too expensive to construct for every file'
+        if self.walker is None:
+            #Needed for removal of unused import messages
+            self.sniffer = MessageSniffer() #Our linter substitution
+            self.walker = PyLintASTWalker(self.sniffer)
+            var_checker = VariablesChecker(self.sniffer)
+            self.walker.add_checker(var_checker)
+
+        return self.sniffer, self.walker
+
 class MessageSniffer(PyLinter):
     'Special class to mimic PyLinter to intercept messages from checkers. Here we use it to collect info about unused imports'
     def __init__(self):
         super(MessageSniffer, self).__init__()
         self.unused = set()
         self.walker = None
-        self.fake_node = None
+        self.fake_globals = frozenset()
 
-    def set_fake_node(self, fake_node):
-        'We need fake node to distinguish real unused imports in user code from unused imports induced by our fake code'
-        self.fake_node = fake_node
+    def set_fake_globals(self, fake_globals):
+        '''
+We need fake globals to distinguish real unused imports in user code from unused imports induced by our fake code.
+fake_globals is frozenset of fake node global names, built once per fake node by the caller
+        '''
+        self.fake_globals = fake_globals
         self.unused = set()
+        #Sniffer is reused for all files, but check_astroid_module doesn't reset per-file state like pylint's own file loop
+        self._ignore_file = False
+        self.file_state = FileState()
 
     def add_message(self, msg_descr, line=None, node=None, args=None, confidence=UNDEFINED):
         'Message interceptor'
@@ -195,16 +280,28 @@ class MessageSniffer(PyLinter):
             self.unused.add(args)
 
         elif msg_descr == 'unused-import':
-            #Unused module or unused symbol from module, extract with regex
-            sym_match = re.match(r'^(.+?)\ imported\ from', args)
-            if sym_match:
-                sym_name = sym_match.group(1)
-            else:
-                module_match = re.match(r'^import\ (.+?)$', args)
-                assert module_match
-                sym_name = module_match.group(1)
-
-            if sym_name in self.fake_node.globals:
+            #Unused symbol from module ("X imported from Y") or unused module ("import X")
+            sym_name, sep, _ = args.partition(' imported from')
+            if not sep:
+                assert args.startswith('import ')
+                sym_name = args[len('import '):]
+
+            if sym_name in self.fake_globals:
                 self.unused.add(sym_name)
 
 transformer = Web2PyTransformer()
+
+#transformer and the regex are bound as defaults, locals are faster than globals on this hot path
+def web2py_transform(module, _transformer=transformer, _match=_WEB2PY_RE.match):
+    'Add imports and some default objects, add custom module paths to pythonpath'
+
+    #Modules imported while transforming are left as is, no need to match them
+    if not _transformer.top_level:
+        return
+
+    #Cheap substring test rules out most non-web2py files before running the regex
+    if module.file and 'applications' in module.file:
+        #Check if this file belongs to web2py
+        web2py_match = _match(module.file)
+        if web2py_match:
+            return _transformer.transform_module(module, *web2py_match.groups())